@@ -18,8 +18,8 @@ data "aws_iam_policy_document" "lambda_policy" {
 }
 
 module "slack_lambda" {
-  source = "github.com/18F/identity-terraform//lambda_function?ref=026f69d0a5e2b8af458888a5f21a72d557bbe1fe"
-  #source = "../lambda_function"
+  # Local source, so the layers input matches this tree's lambda_function
+  source = "../lambda_function"
 
   // region               = var.region
   function_name        = var.lambda_name
@@ -29,6 +29,7 @@ module "slack_lambda" {
   runtime              = "python3.12"
   timeout              = var.lambda_timeout
   memory_size          = var.lambda_memory
+  layers               = var.layers
 
   environment_variables = {
     slack_webhook_url_parameter = var.slack_webhook_url_parameter
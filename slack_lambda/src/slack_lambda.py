@@ -1,15 +1,50 @@
 #!/usr/bin/python3.12
 import boto3
+import concurrent.futures
 import urllib3
 import json
 import os
 import re
 import datetime
 import logging
+import threading
+import time
+
+try:
+    import orjson
+
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    # orjson is shipped via a Lambda layer; fall back to the stdlib without it
+    json_loads = json.loads
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode("utf-8")
+
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Reused across warm invocations so we don't rebuild clients or fetch the
+# webhook URL from SSM for every notification.
+SLACK_URL_TTL_SECONDS = 300
+
+# Records in a batch are posted to Slack concurrently, one connection each
+SLACK_MAX_CONNECTIONS = 8
+
+_SSM_CLIENT = None
+# Kept at module scope so warm invocations reuse the TLS connection to Slack
+_HTTP = urllib3.PoolManager(maxsize=SLACK_MAX_CONNECTIONS)
+_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=SLACK_MAX_CONNECTIONS)
+_SLACK_URL = None
+_SLACK_URL_FETCHED_AT = 0.0
+# boto3 client creation isn't thread-safe, so only one thread may refresh
+_SLACK_URL_LOCK = threading.Lock()
+
+_RUNBOOK_RE = re.compile(r"Runbook: (https://\S+)")
+_RUNBOOK_LINE_RE = re.compile(r"Runbook: (https://\S+)\n")
+
 
 class SlackNotificationFormatter:
     def __init__(
@@ -23,60 +58,32 @@ class SlackNotificationFormatter:
     def format_aws_health_event(self, data={}, slack_username="", slack_icon=""):
 
         details = data["detail"]
-        blocks = [
-            self.blocks_section(
-                "\n".join(
-                    [
-                        "*AWS Health Event*",
-                        f'*Service:* {details["service"]}',
-                        f'*Event Type:* {details["eventTypeCode"]}',
-                        f'*Status:* {details["statusCode"]}',
-                    ]
-                )
-            )
+        description = details["eventDescription"][0]["latestDescription"]
+
+        sections = [
+            "\n".join(
+                [
+                    "*AWS Health Event*",
+                    f'*Service:* {details["service"]}',
+                    f'*Event Type:* {details["eventTypeCode"]}',
+                    f'*Status:* {details["statusCode"]}',
+                ]
+            ),
+            details["eventArn"],
+            "\n".join(["```", description.replace("\\n", "\n"), "```"]),
         ]
 
-        blocks.append(self.blocks_section(details["eventArn"]))
-        blocks.append(
-            self.blocks_section(
-                "\n".join(
-                    [
-                        "```",
-                        f"{details['eventDescription'][0]['latestDescription']}".replace(
-                            "\\n", "\n"
-                        ),
-                        "```",
-                    ]
-                )
-            )
-        )
+        if data["resources"]:
+            sections.append("*Affected Resources:*\n" + "\n".join(data["resources"]))
 
-        if len(data["resources"]) > 0:
-            affected_resources = "*Affected Resources:*\n"
-
-            for resource in data["resources"]:
-                affected_resources = f"{resource}\n"
-
-            blocks.append(self.blocks_section(affected_resources))
-
-        blocks.append(
-            self.blocks_section(
-                "\n".join(
-                    [
-                        f"*Account:* {details['affectedAccount']}",
-                        f"*Region:* {details['eventRegion']}",
-                    ]
-                )
-            )
+        sections.append(
+            f"*Account:* {details['affectedAccount']}\n"
+            f"*Region:* {details['eventRegion']}"
         )
 
-        try:
-            iso_time = datetime.fromisoformat(data["time"])
-            formatted_time = iso_time.strftime("%Y-%m-%d %H:%M:%S %Z")
-        except:
-            formatted_time = data["time"]
+        blocks = [self.blocks_section(section) for section in sections]
 
-        time_information = f"*Notification Time:* {formatted_time}"
+        time_information = f'*Notification Time:* {self.format_time(data["time"])}'
 
         if "startTime" in details:
             time_information += f"\n*Start Time:* {details['startTime']}"
@@ -95,7 +102,7 @@ class SlackNotificationFormatter:
                 f'*{details["service"]}*',
                 f'Event Type: {details["eventTypeCode"]}',
                 f'Status: {details["statusCode"]}',
-                details["eventDescription"][0]["latestDescription"],
+                description,
             ]
         )
 
@@ -170,23 +177,15 @@ class SlackNotificationFormatter:
 
         blocks = [self.blocks_section(f'{alertState} *{data["AlarmName"]}*')]
 
-        try:
-            iso_time = datetime.fromisoformat(
-                data["StateChangeTime"].replace("+0000", "+00:00")
-            )
-            formatted_time = iso_time.strftime("%Y-%m-%d %H:%M:%S %Z")
-        except:
-            formatted_time = data["StateChangeTime"]
+        formatted_time = self.format_time(data["StateChangeTime"])
 
-        match = re.search("Runbook: (https://\\S+)", data["AlarmDescription"])
+        match = _RUNBOOK_RE.search(data["AlarmDescription"])
         if match:
             runbook_url = match.group(1)
 
             blocks[0]["accessory"] = self.runbook_blocks_button(runbook_url)
 
-            description_no_runbook = re.sub(
-                "Runbook: (https://\\S+)\n", "", data["AlarmDescription"]
-            )
+            description_no_runbook = _RUNBOOK_LINE_RE.sub("", data["AlarmDescription"])
             blocks[0]["text"]["text"] += f"\n{description_no_runbook}"
         else:
             blocks.append(self.blocks_section(data["AlarmDescription"]))
@@ -241,10 +240,10 @@ class SlackNotificationFormatter:
             msgtext = f"*INCIDENT CLOSED:* {data['Details']['title']}"
 
         if data["IncidentManagerEvent"] == "ResponderPaged":
-            msgtext = f"*RESPONDER PAGED:* {json.loads(data['Details']['eventData'])['contactArn'].split('/')[-1]}"
+            msgtext = f"*RESPONDER PAGED:* {json_loads(data['Details']['eventData'])['contactArn'].split('/')[-1]}"
 
         if data["IncidentManagerEvent"] == "ResponderAcknowledged":
-            msgtext = f"*RESPONDER ACKNOWLEDGED:* {json.loads(data['Details']['eventData'])['contactArn'].split('/')[-1]}"
+            msgtext = f"*RESPONDER ACKNOWLEDGED:* {json_loads(data['Details']['eventData'])['contactArn'].split('/')[-1]}"
 
         blocks = [self.blocks_section(msgtext)]
 
@@ -270,6 +269,16 @@ class SlackNotificationFormatter:
 
         return msg
 
+    def format_time(self, timestamp):
+        # AWS sends ISO 8601 times ending in either Z or +0000, both of which
+        # fromisoformat accepts natively on Python 3.11+
+        try:
+            iso_time = datetime.datetime.fromisoformat(timestamp)
+        except ValueError:
+            return timestamp
+
+        return iso_time.strftime("%Y-%m-%d %H:%M:%S %Z")
+
     def blocks_section(self, txt):
         return {"type": "section", "text": {"type": "mrkdwn", "text": txt}}
 
@@ -287,7 +296,62 @@ class SlackNotificationFormatter:
         }
 
 
-def get_slack_message_payload(event):
+# Formatter method and keyword arguments for each kind of message returned
+# by classify_message; anything else is sent as a generic message
+MESSAGE_FORMATTERS = {
+    "codepipeline": (
+        SlackNotificationFormatter.format_codebuild_message,
+        {"slack_username": "AWS CodePipeline"},
+    ),
+    "cloudwatch": (
+        SlackNotificationFormatter.format_cloudwatch_alarm_message,
+        {"slack_username": "AWS Cloudwatch Alarm", "slack_icon": ":aws:"},
+    ),
+    "health": (
+        SlackNotificationFormatter.format_aws_health_event,
+        {"slack_username": "AWS Health Event", "slack_icon": ":aws:"},
+    ),
+    "lambda": (
+        SlackNotificationFormatter.format_lambda_monitor_notification,
+        {"slack_username": "Lambda Monitor Notification", "slack_icon": ":aws:"},
+    ),
+    "incidentmanager": (
+        SlackNotificationFormatter.format_aws_incident_manager_message,
+        {"slack_username": "AWS Incident Manager"},
+    ),
+}
+
+
+def classify_message(data):
+    """
+    Function to work out which kind of notification a decoded SNS message is
+
+    :param data: decoded SNS message
+    :returns: str, a MESSAGE_FORMATTERS key or "generic"
+    """
+    detail_type = data.get("detail-type")
+
+    if detail_type == "CodePipeline Pipeline Execution State Change":
+        return "codepipeline"
+    if "AlarmName" in data and "AlarmDescription" in data:
+        return "cloudwatch"
+    if detail_type == "AWS Health Event":
+        return "health"
+    if detail_type == "Lambda Monitor Notification":
+        return "lambda"
+    if "IncidentManagerEvent" in data:
+        return "incidentmanager"
+    return "generic"
+
+
+def get_slack_message_payload(event, eventmsg):
+    """
+    Function to build the Slack payload for a single SNS message
+
+    :param event: lambda expected event object
+    :param eventmsg: SNS message from one of the event's records
+    :returns: dict
+    """
     formatter = SlackNotificationFormatter(
         event=event,
         default_slack_username=os.environ["slack_username"],
@@ -295,55 +359,27 @@ def get_slack_message_payload(event):
         slack_channel=os.environ["slack_channel"],
     )
 
-    eventmsg = event["Records"][0]["Sns"]["Message"]
+    # Every structured notification is a JSON object, so skip decoding
+    # anything else and send it as-is
+    if eventmsg.lstrip()[:1] != "{":
+        logger.info("generic")
+        return formatter.format_generic_slack_message(
+            eventmsg,
+        )
 
     try:
-        data = json.loads(eventmsg)
-
-        if (
-            "detail-type" in data
-            and data["detail-type"] == "CodePipeline Pipeline Execution State Change"
-        ):
-            return formatter.format_codebuild_message(
-                data,
-                slack_username="AWS CodePipeline",
-            )
-        elif "AlarmName" in data and "AlarmDescription" in data:
-            logger.info("cloudwatch")
-            return formatter.format_cloudwatch_alarm_message(
-                data,
-                slack_username="AWS Cloudwatch Alarm",
-                slack_icon=":aws:",
-            )
-        elif "detail-type" in data and data["detail-type"] == "AWS Health Event":
-            logger.info("health")
-            return formatter.format_aws_health_event(
-                data,
-                slack_username="AWS Health Event",
-                slack_icon=":aws:",
-            )
-        elif (
-            "detail-type" in data
-            and data["detail-type"] == "Lambda Monitor Notification"
-        ):
-            logger.info("lambda")
-            return formatter.format_lambda_monitor_notification(
-                data,
-                slack_username="Lambda Monitor Notification",
-                slack_icon=":aws:",
-            )
-        elif "IncidentManagerEvent" in data:
-            logger.info("incidentmanager")
-            return formatter.format_aws_incident_manager_message(
-                data,
-                slack_username="AWS Incident Manager",
-            )
-        else:
-            logger.info("generic")
+        data = json_loads(eventmsg)
+        kind = classify_message(data)
+        logger.info(kind)
+
+        if kind == "generic":
             return formatter.format_generic_slack_message(
                 eventmsg,
             )
 
+        format_message, kwargs = MESSAGE_FORMATTERS[kind]
+        return format_message(formatter, data, **kwargs)
+
     except Exception as e:
         logger.info("exception")
         logger.error(e)
@@ -352,49 +388,120 @@ def get_slack_message_payload(event):
         )
 
 
-def send_slack_notification(payload):
+def get_slack_webhook_url():
+    """
+    Function to fetch the Slack webhook URL from SSM, cached for
+    SLACK_URL_TTL_SECONDS so that a rotated parameter is eventually picked up
+
+    :returns: str
+    """
+    global _SSM_CLIENT, _SLACK_URL, _SLACK_URL_FETCHED_AT
+
+    with _SLACK_URL_LOCK:
+        now = time.monotonic()
+        if _SLACK_URL is None or now - _SLACK_URL_FETCHED_AT > SLACK_URL_TTL_SECONDS:
+            if _SSM_CLIENT is None:
+                _SSM_CLIENT = boto3.client("ssm")
+            slackUrlParam = os.environ["slack_webhook_url_parameter"]
+            _SLACK_URL = _SSM_CLIENT.get_parameter(
+                Name=slackUrlParam, WithDecryption=True
+            )["Parameter"]["Value"]
+            _SLACK_URL_FETCHED_AT = now
+
+        return _SLACK_URL
+
+
+def send_slack_notification(payload, url=None):
     """
     Function to forward messages to Slack
 
     :param payload: Slack message payload
+    :param url: Slack webhook URL, fetched with get_slack_webhook_url if unset
     :returns: urllib3.response
     """
-    ssm = boto3.client("ssm")
-    slackUrlParam = os.environ["slack_webhook_url_parameter"]
-    url = ssm.get_parameter(Name=slackUrlParam, WithDecryption=True)["Parameter"][
-        "Value"
-    ]
-
-    http = urllib3.PoolManager()
-
-    return http.request("POST", url, body=json.dumps(payload).encode("utf-8"))
+    return _HTTP.request(
+        "POST",
+        url or get_slack_webhook_url(),
+        body=json_dumps(payload),
+        headers={"Content-Type": "application/json"},
+    )
 
 
-def lambda_handler(event, context):
+def notify_slack(event, record, url):
     """
-    Lambda function to parse notification events and forward to Slack
+    Function to format a single SNS record and forward it to Slack. Successes
+    are logged by SNS message ID only; the message and payload are logged in
+    full on failure, or at DEBUG level. Exceptions are logged and returned as
+    None so the other records are still posted; lambda_handler raises after.
 
     :param event: lambda expected event object
-    :param context: lambda expected context object
-    :returns: none
+    :param record: one of the event's SNS records
+    :param url: Slack webhook URL
+    :returns: int, the Slack response status, or None if posting raised
     """
-    payload = get_slack_message_payload(event)
+    eventmsg = record["Sns"]["Message"]
+    message_id = record["Sns"].get("MessageId")
 
-    response = send_slack_notification(payload)
+    try:
+        payload = get_slack_message_payload(event, eventmsg)
+        response = send_slack_notification(payload, url)
+    except Exception:
+        logger.exception({"message_id": message_id, "message": eventmsg})
+        return None
 
     if response.status != 200:
-        return logger.error(
+        logger.error(
             {
+                "message_id": message_id,
+                "message": eventmsg,
+                "slack_payload": payload,
                 "status_code": response.status,
                 "response": response.data,
             }
         )
-    else:
-        return logger.info(
+    elif logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
             {
-                "message": event["Records"][0]["Sns"]["Message"],
+                "message_id": message_id,
+                "message": eventmsg,
                 "slack_payload": payload,
                 "status_code": response.status,
                 "response": response.data,
             }
         )
+    elif logger.isEnabledFor(logging.INFO):
+        logger.info({"message_id": message_id, "status_code": response.status})
+
+    return response.status
+
+
+def lambda_handler(event, context):
+    """
+    Lambda function to parse notification events and forward to Slack.
+    Each SNS record is posted concurrently, so batched messages may arrive in
+    Slack out of order. If posting any record raised, a RuntimeError is raised
+    once every record has been tried, so the invocation fails and is retried.
+
+    :param event: lambda expected event object
+    :param context: lambda expected context object
+    :returns: none
+    """
+    # Resolve the webhook URL once, before fanning out to worker threads
+    url = get_slack_webhook_url()
+
+    statuses = list(
+        _EXECUTOR.map(
+            lambda record: notify_slack(event, record, url),
+            event["Records"],
+        )
+    )
+
+    failures = sum(1 for status in statuses if status != 200)
+    if failures:
+        logger.error(f"{failures} of {len(statuses)} Slack notifications failed")
+
+    errors = sum(1 for status in statuses if status is None)
+    if errors:
+        raise RuntimeError(
+            f"{errors} of {len(statuses)} Slack notifications raised an exception"
+        )
@@ -1,19 +1,39 @@
 import boto3
+import importlib.util
 import logging
 import os
 import pytest
 import json
+import sys
 import unittest
 import urllib3
 from moto import mock_aws
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, ANY, MagicMock
+import slack_lambda
 from slack_lambda import (
     lambda_handler,
     SlackNotificationFormatter,
     send_slack_notification,
     get_slack_message_payload,
+    get_slack_webhook_url,
 )
 
+SLACK_URL = "https://hooks.slack.com/services/TEST"
+
+
+def load_without_orjson():
+    """
+    Loads a separate copy of slack_lambda with orjson unimportable, so the
+    stdlib fallback is tested even where orjson is installed
+    """
+    spec = importlib.util.spec_from_file_location(
+        "slack_lambda_stdlib_json", slack_lambda.__file__
+    )
+    module = importlib.util.module_from_spec(spec)
+    with patch.dict(sys.modules, {"orjson": None}):
+        spec.loader.exec_module(module)
+    return module
+
 
 @unittest.mock.patch.dict(
     os.environ,
@@ -75,8 +95,66 @@ class SlackNotificationsTest(unittest.TestCase):
         self.assertEqual(payload["channel"], os.environ["slack_channel"])
         self.assertEqual(payload["username"], "AWS Cloudwatch Alarm")
         self.assertIn("test-idp-unhealthy-instances", payload["text"])
+        self.assertIn("*Time*: 2024-05-21 08:35:10 UTC", payload["text"])
         self.assertEqual(payload["icon_emoji"], ":aws:")
 
+    def test_format_cloudwatch_alarm_message_with_runbook(self):
+        event = self.load_file("cloudwatch_alarm_message")
+        data = json.loads(event["Records"][0]["Sns"]["Message"])
+        data["AlarmDescription"] = (
+            "Runbook: https://example.com/runbook\nInstances have fallen ill"
+        )
+        payload = SlackNotificationFormatter(
+            event=event,
+            default_slack_username=os.environ["slack_username"],
+            default_slack_icon=os.environ["slack_icon"],
+            slack_channel=os.environ["slack_channel"],
+        ).format_cloudwatch_alarm_message(
+            data,
+            slack_username="AWS Cloudwatch Alarm",
+            slack_icon=":aws:",
+        )
+        self.assertEqual(
+            payload["blocks"][0]["accessory"]["url"], "https://example.com/runbook"
+        )
+        self.assertNotIn("Runbook:", payload["blocks"][0]["text"]["text"])
+        self.assertIn("Instances have fallen ill", payload["blocks"][0]["text"]["text"])
+
+    def test_format_aws_health_event(self):
+        event = self.load_file("aws_health_event_message")
+        data = json.loads(event["Records"][0]["Sns"]["Message"])
+        data["resources"].append("arn:aws:acm:us-west-2:100000000001:certificate/2")
+        payload = SlackNotificationFormatter(
+            event=event,
+            default_slack_username=os.environ["slack_username"],
+            default_slack_icon=os.environ["slack_icon"],
+            slack_channel=os.environ["slack_channel"],
+        ).format_aws_health_event(
+            data,
+            slack_username="AWS Health Event",
+            slack_icon=":aws:",
+        )
+        self.assertEqual(payload["username"], "AWS Health Event")
+        self.assertIn("AWS_ACM_RENEWAL_STATE_CHANGE", payload["text"])
+        self.assertEqual(
+            payload["blocks"][3]["text"]["text"],
+            "\n".join(
+                [
+                    "*Affected Resources:*",
+                    "arn:aws:acm:us-west-2:100000000001:certificate/c8a4d81d-6004-4c2a-9465-000000000000",
+                    "arn:aws:acm:us-west-2:100000000001:certificate/2",
+                ]
+            ),
+        )
+        self.assertEqual(
+            payload["blocks"][4]["text"]["text"],
+            "*Account:* 100000000001\n*Region:* us-west-2",
+        )
+        self.assertIn(
+            "*Notification Time:* 2024-05-20 02:17:35 UTC",
+            payload["blocks"][5]["text"]["text"],
+        )
+
     def test_format_generic_slack_message(self):
         event = self.load_file("generic_message")
         eventmsg = event["Records"][0]["Sns"]["Message"]
@@ -113,6 +191,228 @@ class SlackNotificationsTest(unittest.TestCase):
         )
         self.assertEqual(payload["icon_emoji"], os.environ["slack_icon"])
 
+    def test_get_slack_message_payload(self):
+        for filename, username in [
+            ("codebuild_message", "AWS CodePipeline"),
+            ("cloudwatch_alarm_message", "AWS Cloudwatch Alarm"),
+            ("aws_health_event_message", "AWS Health Event"),
+            ("aws_incident_manager_shift_message", "AWS Incident Manager"),
+            ("generic_message", os.environ["slack_username"]),
+        ]:
+            event = self.load_file(filename)
+            payload = get_slack_message_payload(
+                event, event["Records"][0]["Sns"]["Message"]
+            )
+            self.assertEqual(payload["username"], username, filename)
+
+    @patch("slack_lambda.json_loads")
+    def test_get_slack_message_payload_skips_decoding_plain_text(self, mock_loads):
+        payload = get_slack_message_payload({}, "This is a generic text message")
+
+        mock_loads.assert_not_called()
+        self.assertEqual(payload["text"], "This is a generic text message")
+
+    @patch("slack_lambda.get_slack_webhook_url", return_value=SLACK_URL)
+    @patch("slack_lambda.send_slack_notification")
+    def test_lambda_handler_sends_every_record(self, mock_send, mock_url):
+        mock_send.return_value = MagicMock(status=200, data=b"ok")
+        event = {
+            "Records": [
+                {"Sns": {"Message": "first message"}},
+                {"Sns": {"Message": "second message"}},
+            ]
+        }
+
+        lambda_handler(event, None)
+
+        self.assertCountEqual(
+            [c.args[0]["text"] for c in mock_send.call_args_list],
+            ["first message", "second message"],
+        )
+        # The URL is resolved once, before records are posted concurrently
+        mock_url.assert_called_once_with()
+        self.assertEqual(
+            [c.args[1] for c in mock_send.call_args_list], [SLACK_URL, SLACK_URL]
+        )
+
+    @patch("slack_lambda.logger")
+    @patch("slack_lambda.get_slack_webhook_url", return_value=SLACK_URL)
+    @patch("slack_lambda.send_slack_notification")
+    def test_lambda_handler_raises_after_posting_every_record(
+        self, mock_send, mock_url, mock_logger
+    ):
+        def send(payload, url):
+            if payload["text"] == "bad message":
+                raise urllib3.exceptions.MaxRetryError(None, url)
+            return MagicMock(status=200, data=b"ok")
+
+        mock_send.side_effect = send
+        event = {
+            "Records": [
+                {"Sns": {"Message": "bad message"}},
+                {"Sns": {"Message": "good message"}},
+            ]
+        }
+
+        with self.assertRaisesRegex(
+            RuntimeError, "1 of 2 Slack notifications raised an exception"
+        ):
+            lambda_handler(event, None)
+
+        # The good record is still posted before the invocation fails
+        self.assertCountEqual(
+            [c.args[0]["text"] for c in mock_send.call_args_list],
+            ["bad message", "good message"],
+        )
+        mock_logger.exception.assert_called_once_with(
+            {"message_id": None, "message": "bad message"}
+        )
+        mock_logger.error.assert_called_with("1 of 2 Slack notifications failed")
+
+    @patch("slack_lambda.logger")
+    @patch("slack_lambda.get_slack_webhook_url", return_value=SLACK_URL)
+    @patch("slack_lambda.send_slack_notification")
+    def test_lambda_handler_logs_success_by_message_id(
+        self, mock_send, mock_url, mock_logger
+    ):
+        mock_send.return_value = MagicMock(status=200, data=b"ok")
+        mock_logger.isEnabledFor.side_effect = lambda level: level >= logging.INFO
+        event = {
+            "Records": [
+                {"Sns": {"MessageId": "95df01b4-ee98", "Message": "pytest message"}}
+            ]
+        }
+
+        lambda_handler(event, None)
+
+        mock_logger.info.assert_called_with(
+            {"message_id": "95df01b4-ee98", "status_code": 200}
+        )
+        logged = [c.args[0] for c in mock_logger.info.call_args_list]
+        self.assertFalse(
+            any(
+                isinstance(entry, dict)
+                and ("slack_payload" in entry or "message" in entry)
+                for entry in logged
+            )
+        )
+        mock_logger.debug.assert_not_called()
+        mock_logger.error.assert_not_called()
+
+    @patch("slack_lambda.get_slack_webhook_url", return_value=SLACK_URL)
+    @patch("slack_lambda.send_slack_notification")
+    def test_lambda_handler_logs_nothing_when_info_disabled(self, mock_send, mock_url):
+        mock_send.return_value = MagicMock(status=200, data=b"ok")
+        event = {
+            "Records": [
+                {"Sns": {"MessageId": "95df01b4-ee98", "Message": "pytest message"}}
+            ]
+        }
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        slack_lambda.logger.addHandler(handler)
+        slack_lambda.logger.setLevel(logging.WARNING)
+        try:
+            lambda_handler(event, None)
+        finally:
+            slack_lambda.logger.removeHandler(handler)
+            slack_lambda.logger.setLevel(logging.INFO)
+
+        self.assertEqual(records, [])
+
+    @patch("slack_lambda.logger")
+    @patch("slack_lambda.get_slack_webhook_url", return_value=SLACK_URL)
+    @patch("slack_lambda.send_slack_notification")
+    def test_lambda_handler_logs_slack_errors(self, mock_send, mock_url, mock_logger):
+        # Slack webhooks reply with plain text, so only the status is checked
+        mock_send.return_value = MagicMock(status=404, data=b"no_service")
+
+        lambda_handler({"Records": [{"Sns": {"Message": "pytest message"}}]}, None)
+
+        mock_logger.error.assert_any_call(
+            {
+                "message_id": None,
+                "message": "pytest message",
+                "slack_payload": ANY,
+                "status_code": 404,
+                "response": b"no_service",
+            }
+        )
+        mock_logger.error.assert_called_with("1 of 1 Slack notifications failed")
+
+    @patch.object(slack_lambda, "_SLACK_URL_FETCHED_AT", 0.0)
+    @patch.object(slack_lambda, "_SLACK_URL", None)
+    @patch.object(slack_lambda, "_SSM_CLIENT", None)
+    @patch("slack_lambda.boto3.client")
+    def test_get_slack_webhook_url_is_cached(self, mock_client):
+        mock_client.return_value.get_parameter.return_value = {
+            "Parameter": {"Value": SLACK_URL}
+        }
+
+        self.assertEqual(get_slack_webhook_url(), SLACK_URL)
+        self.assertEqual(get_slack_webhook_url(), SLACK_URL)
+
+        mock_client.assert_called_once_with("ssm")
+        mock_client.return_value.get_parameter.assert_called_once_with(
+            Name="/slackurl/param", WithDecryption=True
+        )
+
+    @patch.object(slack_lambda, "_SLACK_URL_FETCHED_AT", 0.0)
+    @patch.object(slack_lambda, "_SLACK_URL", None)
+    @patch.object(slack_lambda, "_SSM_CLIENT", None)
+    @patch("slack_lambda.time.monotonic")
+    @patch("slack_lambda.boto3.client")
+    def test_get_slack_webhook_url_refreshes_after_ttl(
+        self, mock_client, mock_monotonic
+    ):
+        mock_client.return_value.get_parameter.side_effect = [
+            {"Parameter": {"Value": SLACK_URL}},
+            {"Parameter": {"Value": SLACK_URL + "/rotated"}},
+        ]
+        ttl = slack_lambda.SLACK_URL_TTL_SECONDS
+
+        mock_monotonic.return_value = 1000.0
+        self.assertEqual(get_slack_webhook_url(), SLACK_URL)
+
+        mock_monotonic.return_value = 1000.0 + ttl
+        self.assertEqual(get_slack_webhook_url(), SLACK_URL)
+
+        mock_monotonic.return_value = 1000.0 + ttl + 1
+        self.assertEqual(get_slack_webhook_url(), SLACK_URL + "/rotated")
+
+        self.assertEqual(mock_client.return_value.get_parameter.call_count, 2)
+        # The client itself is reused across refreshes
+        mock_client.assert_called_once_with("ssm")
+
+    @patch("slack_lambda.get_slack_webhook_url")
+    @patch("slack_lambda._HTTP")
+    def test_send_slack_notification(self, mock_http, mock_url):
+        mock_url.return_value = "https://hooks.slack.com/services/TEST"
+
+        send_slack_notification({"text": "TEST"})
+
+        mock_http.request.assert_called_once_with(
+            "POST",
+            "https://hooks.slack.com/services/TEST",
+            body=ANY,
+            headers={"Content-Type": "application/json"},
+        )
+        self.assertEqual(
+            json.loads(mock_http.request.call_args.kwargs["body"]), {"text": "TEST"}
+        )
+
+    def test_stdlib_json_fallback(self):
+        module = load_without_orjson()
+
+        self.assertIs(module.json_loads, json.loads)
+        self.assertEqual(module.json_dumps({"text": "TEST"}), b'{"text": "TEST"}')
+        event = self.load_file("codebuild_message")
+        payload = module.get_slack_message_payload(
+            event, event["Records"][0]["Sns"]["Message"]
+        )
+        self.assertEqual(payload["username"], "AWS CodePipeline")
+
     def load_file(self, filename):
         with open(os.path.join(os.path.dirname(__file__), f"{filename}.json")) as f:
             return json.loads(f.read())
@@ -28,6 +28,12 @@ variable "lambda_runtime" {
   default     = "python3.12"
 }
 
+variable "layers" {
+  description = "List of Lambda layer ARNs to attach, e.g. one providing orjson for faster JSON handling."
+  type        = list(string)
+  default     = []
+}
+
 variable "slack_webhook_url_parameter" {
   description = "Slack Webhook URL SSM Parameter."
   type        = string
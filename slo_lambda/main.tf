@@ -33,7 +33,7 @@ data "aws_iam_policy_document" "lambda_policy" {
     effect = "Allow"
     actions = [
       "cloudwatch:PutMetricData",
-      "cloudwatch:GetMetricStatistics",
+      "cloudwatch:GetMetricData",
     ]
     resources = [
       # Change this once we know what the resources are, from errors.
@@ -91,6 +91,7 @@ resource "aws_lambda_function" "windowed_slo" {
   runtime          = var.lambda_runtime
   timeout          = 30
   memory_size      = 128
+  layers           = var.layers
 
   environment {
     variables = {
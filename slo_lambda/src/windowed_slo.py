@@ -3,13 +3,21 @@ Given SLIs that contain ratios of CloudWatch metrics, writes new metrics that
 aggregate over window_days and calculate the ratios.
 """
 
-from typing import Any, Dict, List, Optional, TypedDict, Union
+from typing import Any, Dict, List, Optional, Tuple, TypedDict, Union
+import concurrent.futures
 import datetime
 import json
 import os
 import boto3  # type: ignore
 import botocore  # type: ignore
 
+try:
+    import orjson  # type: ignore
+
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
 
 # ENVIRONMENT VARIABLES
 # Namespace of resulting SLI metrics
@@ -21,23 +29,19 @@ SLIS = os.getenv("SLIS")
 # If no window is specified, how long to calculate the SLI for
 WINDOW_DAYS = int(os.getenv("WINDOW_DAYS", 28))
 
+# Shared Cloudwatch client, created at import time so it is ready before the
+# first invocation
+CLOUDWATCH = boto3.client("cloudwatch")
 
-class Cloudwatch:
-    """
-    Cloudwatch contains a single Cloudwatch client so we don't have to
-    reinitialize it or pass it as an argument everywhere.
-    """
+# Most MetricDataQueries a single GetMetricData call accepts
+MAX_METRIC_DATA_QUERIES = 500
 
-    cloudwatch_client = None
+# Most MetricData entries a single PutMetricData call accepts
+MAX_PUT_METRIC_DATA = 1000
 
-    @classmethod
-    def client(cls):
-        """
-        client returns an initialized Cloudwatch client or creates a new one.
-        """
-        if cls.cloudwatch_client is None:
-            cls.cloudwatch_client = boto3.client("cloudwatch")
-        return cls.cloudwatch_client
+# GetMetricData calls for different windows are independent and network
+# bound, so run them concurrently. Sized to botocore's default connection pool.
+EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=10)
 
 
 class SingleMetric:
@@ -61,6 +65,7 @@ class SingleMetric:
     def __init__(
         self,
         window_days: int,
+        end_time: datetime.datetime,
         namespace: str,
         metric_name: str,
         dimensions: List,
@@ -68,50 +73,34 @@ class SingleMetric:
         extended_statistic: Optional[str] = None,
         multiplier: float = 1.0,
     ):
-        self.namespace = namespace
-        self.metric_name = metric_name
-        self.dimensions = dimensions
-        self.statistic = statistic
-        self.extended_statistic = extended_statistic
+        self.start_time = end_time - datetime.timedelta(days=window_days)
+        self.end_time = end_time
         self.multiplier = float(multiplier)
 
-        self.stat_args = {
-            "StartTime": datetime.datetime.utcnow()
-            - datetime.timedelta(days=window_days),
-            "EndTime": datetime.datetime.utcnow(),
-            "Period": window_days * 24 * 60 * 60,
-        }
         if extended_statistic:
-            self.stat_args["ExtendedStatistics"] = [extended_statistic]
+            stat = extended_statistic
         elif statistic:
-            self.stat_args["Statistics"] = [statistic]
+            stat = statistic
         else:
-            self.statistic = "Sum"
-            self.stat_args["Statistics"] = ["Sum"]
+            stat = "Sum"
+
+        # Built once here; only the query Id varies between requests
+        self.metric_stat = {
+            "Metric": {
+                "Namespace": namespace,
+                "MetricName": metric_name,
+                "Dimensions": dimensions,
+            },
+            "Period": window_days * 24 * 60 * 60,
+            "Stat": stat,
+        }
 
-    def sum(self) -> float:
-        """
-        sum returns the sum of a single cloudwatch metric over window_days
-        multiplied by the multiplier.
-        """
-        total = 0.0
-        for datapoint in Cloudwatch.client().get_metric_statistics(
-            Namespace=self.namespace,
-            MetricName=self.metric_name,
-            Dimensions=self.dimensions,
-            **self.stat_args,
-        )["Datapoints"]:
-            total += self.extract_stat(datapoint)
-        return total * self.multiplier
-
-    def extract_stat(self, datapoint: Dict) -> float:
+    def query(self, query_id: str) -> Dict:
         """
-        extract_stat takes a Cloudwatch datapoint and returns the numeric value
+        query returns the MetricDataQuery for this metric aggregated over
+        window_days, for use with GetMetricData.
         """
-        if self.extended_statistic:
-            return datapoint["ExtendedStatistics"][self.extended_statistic]
-
-        return datapoint[self.statistic]
+        return {"Id": query_id, "MetricStat": self.metric_stat, "ReturnData": True}
 
 
 class CompositeMetric:
@@ -119,14 +108,23 @@ class CompositeMetric:
     Holds multiple SingleMetrics allowing for returning the sum of the metrics.
     """
 
-    def __init__(self, window_days: int, metrics: List[Dict]):
-        self.metrics = [SingleMetric(window_days=window_days, **m) for m in metrics]
+    def __init__(
+        self, window_days: int, end_time: datetime.datetime, metrics: List[Dict]
+    ):
+        self.metrics = [
+            SingleMetric(window_days=window_days, end_time=end_time, **m)
+            for m in metrics
+        ]
 
-    def sum(self) -> float:
+    def sum(self, sums: Dict[SingleMetric, float]) -> float:
+        """
+        sum returns the total of the metrics, given the per-metric sums
+        returned by fetch_metric_sums.
+        """
         total = 0.0
 
         for m in self.metrics:
-            total += m.sum()
+            total += sums[m]
 
         return total
 
@@ -163,20 +161,129 @@ class SLI:
         denominator: List[Dict],
         description: str = "",
         window_days: int = WINDOW_DAYS,
+        end_time: Optional[datetime.datetime] = None,
     ):
         if window_days is None:
             window_days = WINDOW_DAYS
-        self.numerator = CompositeMetric(window_days=window_days, metrics=numerator)
-        self.denominator = CompositeMetric(window_days=window_days, metrics=denominator)
+        if end_time is None:
+            end_time = datetime.datetime.utcnow()
+        self.numerator = CompositeMetric(
+            window_days=window_days, end_time=end_time, metrics=numerator
+        )
+        self.denominator = CompositeMetric(
+            window_days=window_days, end_time=end_time, metrics=denominator
+        )
+
+    def gather_metrics(self) -> List[SingleMetric]:
+        """
+        gather_metrics returns every metric in the numerator and denominator,
+        so they can be fetched together with fetch_metric_sums.
+        """
+        return self.numerator.metrics + self.denominator.metrics
 
-    def get_ratio(self) -> float:
+    def get_ratio(self, sums: Dict[SingleMetric, float]) -> float:
         """
         get_ratio returns the sum of the numerator divided by the sum of the
         denominator, calculated over the last window_days.
 
         Can return ZeroDivisonError.
         """
-        return self.numerator.sum() / self.denominator.sum()
+        return self.numerator.sum(sums) / self.denominator.sum(sums)
+
+
+def fetch_metric_sums(
+    metrics: List[SingleMetric],
+    handle_exceptions: bool = True,
+) -> Tuple[Dict[SingleMetric, float], Dict[SingleMetric, str]]:
+    """
+    fetch_metric_sums queries all of the given metrics using as few
+    GetMetricData calls as possible, run concurrently, and returns the sum of
+    each metric over its window_days multiplied by its multiplier, along with
+    the reason for each metric CloudWatch could not return.
+
+    A CloudWatch API error only fails the metrics in that call, unless
+    handle_exceptions is False, in which case it is raised.
+    """
+    # GetMetricData takes a single time range per call, so group by window.
+    # Within a window, metrics with identical MetricStats (e.g. a denominator
+    # shared by several SLIs) are queried once.
+    by_window: Dict[
+        Tuple[datetime.datetime, datetime.datetime], Dict[str, List[SingleMetric]]
+    ] = {}
+    for m in metrics:
+        queries = by_window.setdefault((m.start_time, m.end_time), {})
+        queries.setdefault(json.dumps(m.metric_stat, sort_keys=True), []).append(m)
+
+    batches = []
+    for (start_time, end_time), queries in by_window.items():
+        shared = list(queries.values())
+        for i in range(0, len(shared), MAX_METRIC_DATA_QUERIES):
+            batch = shared[i : i + MAX_METRIC_DATA_QUERIES]
+            batches.append(
+                (batch, EXECUTOR.submit(fetch_batch_sums, batch, start_time, end_time))
+            )
+
+    sums: Dict[SingleMetric, float] = {}
+    failed: Dict[SingleMetric, str] = {}
+    for batch, future in batches:
+        try:
+            batch_sums, batch_failed = future.result()
+        except (
+            botocore.exceptions.ClientError,
+            botocore.exceptions.BotoCoreError,
+        ) as e:
+            if not handle_exceptions:
+                raise
+            failed.update({m: str(e) for group in batch for m in group})
+            continue
+        sums.update(batch_sums)
+        failed.update(batch_failed)
+
+    return sums, failed
+
+
+def fetch_batch_sums(
+    groups: List[List[SingleMetric]],
+    start_time: datetime.datetime,
+    end_time: datetime.datetime,
+) -> Tuple[Dict[SingleMetric, float], Dict[SingleMetric, str]]:
+    """
+    fetch_batch_sums queries up to MAX_METRIC_DATA_QUERIES metrics sharing a
+    time range with a single (paginated) GetMetricData call. Each group holds
+    metrics with the same MetricStat, which are sent as one query and each
+    scaled by their own multiplier.
+
+    Results with a StatusCode other than Complete or PartialData (e.g.
+    InternalError, Forbidden) have no usable Values, so those metrics are
+    returned as failed rather than summed as 0.
+    """
+    by_id = {"m%d" % n: group for n, group in enumerate(groups)}
+    totals = {query_id: 0.0 for query_id in by_id}
+    errors: Dict[str, str] = {}
+
+    paginator = CLOUDWATCH.get_paginator("get_metric_data")
+    for page in paginator.paginate(
+        MetricDataQueries=[
+            group[0].query(query_id) for query_id, group in by_id.items()
+        ],
+        StartTime=start_time,
+        EndTime=end_time,
+    ):
+        for result in page["MetricDataResults"]:
+            if result["StatusCode"] not in ("Complete", "PartialData"):
+                messages = [msg["Value"] for msg in result.get("Messages", [])]
+                errors[result["Id"]] = "%s %s" % (result["StatusCode"], messages)
+                continue
+            totals[result["Id"]] += sum(result["Values"])
+
+    sums = {
+        m: totals[query_id] * m.multiplier
+        for query_id, group in by_id.items()
+        if query_id not in errors
+        for m in group
+    }
+    failed = {m: error for query_id, error in errors.items() for m in by_id[query_id]}
+    return sums, failed
 
 
 def publish_slis(
@@ -189,49 +296,65 @@ def publish_slis(
     create_slis takes a dictionary of SLIs, gets their values and writes the
     associated Cloudwatch metrics.
     """
+    # Fetch every metric from every SLI up front, so numerators and
+    # denominators share the same GetMetricData calls
+    metrics = []
+    for sli in slis.values():
+        metrics.extend(sli.gather_metrics())
+
+    sums, failed = fetch_metric_sums(metrics, handle_exceptions=handle_exceptions)
+
+    metric_data = []
     for sli_name, sli in slis.items():
+        errors = [failed[m] for m in sli.gather_metrics() if m in failed]
+        if errors:
+            print("CloudWatch API error for %s: %s" % (sli_name, "; ".join(errors)))
+            continue
+
         try:
-            value = sli.get_ratio()
+            value = sli.get_ratio(sums)
         except ZeroDivisionError:
             print("x/0 error for %s" % sli_name)
             continue
-        except (
-            botocore.exceptions.ClientError,
-            botocore.exceptions.BotoCoreError,
-        ) as e:
-            if not handle_exceptions:
-                raise
-            print("CloudWatch API error for %s: %s" % (sli_name, e))
-            continue
 
         print("%s: %f" % (sli_name, value))
-        metric_data = [
+        metric_data.append(
             {
                 "MetricName": sli_prefix + "-" + sli_name,
                 "Value": value,
             }
-        ]
-        Cloudwatch.client().put_metric_data(
+        )
+
+    for i in range(0, len(metric_data), MAX_PUT_METRIC_DATA):
+        CLOUDWATCH.put_metric_data(
             Namespace=sli_namespace,
-            MetricData=metric_data,
+            MetricData=metric_data[i : i + MAX_PUT_METRIC_DATA],
         )
 
 
-def parse_sli_json(sli_json: str, handle_exceptions: bool = True) -> Dict[str, SLI]:
+def parse_sli_json(
+    sli_json: str,
+    handle_exceptions: bool = True,
+    end_time: Optional[datetime.datetime] = None,
+) -> Dict[str, SLI]:
     """
     Takes JSON (usually generated by Terraform), initializes
     SLI objects from the resulting dictionaries, and returns a dictionary of
     SLI definitions.  If provided the optional window_days value defines the
     evaluation period for the generated SLI objects.  (Default: 30)
+
+    All SLIs share end_time (default: now) so their windows line up.
     """
+    if end_time is None:
+        end_time = datetime.datetime.utcnow()
 
-    sli_configs = json.loads(sli_json)
+    sli_configs = json_loads(sli_json)
     slis = {}
     # Since the SLIs were defined in Terraform and converted to JSON
     # dictionaries, we need to convert them to SLI objects.
     for sli_name, sli_config in sli_configs.items():
         try:
-            slis[sli_name] = SLI(**sli_config)
+            slis[sli_name] = SLI(end_time=end_time, **sli_config)
         except (KeyError, TypeError, ValueError) as e:
             if not handle_exceptions:
                 raise
@@ -249,8 +372,9 @@ def lambda_handler(event, context):
     if SLIS is None:
         raise RuntimeError("SLIS definition JSON not set in environment")
 
-    # Parse SLIs into SLI objects
-    slis = parse_sli_json(sli_json=SLIS)
+    # Parse SLIs into SLI objects, all evaluated as of the same moment
+    now = datetime.datetime.utcnow()
+    slis = parse_sli_json(sli_json=SLIS, end_time=now)
 
     # Write SLI metrics from the SLI definitions
     publish_slis(slis=slis, sli_namespace=SLI_NAMESPACE, sli_prefix=SLI_PREFIX)
@@ -1,48 +1,101 @@
 import os
 import boto3
+import botocore
+import concurrent.futures
+import datetime
+import importlib.util
 import json
+import sys
 from botocore.stub import Stubber, ANY
 from moto import mock_aws
+from unittest.mock import patch
 import pytest
 
 os.environ["WINDOW_DAYS"] = "24"
 SLI_NAMESPACE = "test/sli"
 SLI_PREFIX = "test"
 os.environ["SLIS"] = ""
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-west-2")
 
 # This import relies on our env var insertions above, so can't be reordered
 # autopep8: off
-from windowed_slo import parse_sli_json, publish_slis, Cloudwatch
+import windowed_slo
+from windowed_slo import parse_sli_json, publish_slis
 
 # autopep8: on
 
 LOAD_BALANCER_ID = "app/login-idp-alb-pretend/1234"
 
+# Stubber hands out responses in call order, so issue GetMetricData calls
+# one at a time to keep that order deterministic
+windowed_slo.EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=1)
 
-def get_metric_statistics(metric_name, datapoints_sum):
+
+def metric_data_query(query_id, metric_name, period=2073600):
+    return {
+        "Id": query_id,
+        "MetricStat": {
+            "Metric": {
+                "Namespace": "AWS/ApplicationELB",
+                "MetricName": metric_name,
+                "Dimensions": [
+                    {"Name": "LoadBalancer", "Value": "app/login-idp-alb-pretend/1234"}
+                ],
+            },
+            "Period": period,
+            "Stat": "Sum",
+        },
+        "ReturnData": True,
+    }
+
+
+def metric_data_result(query_id, value):
+    if value is None:
+        return {
+            "Id": query_id,
+            "Values": [],
+            "StatusCode": "InternalError",
+            "Messages": [{"Code": "InternalError", "Value": "Internal error"}],
+        }
+    return {"Id": query_id, "Values": [value], "StatusCode": "Complete"}
+
+
+def get_metric_data(metrics, period=2073600, start_time=ANY, end_time=ANY):
+    """
+    metrics is a list of (metric_name, value) tuples, in query order. A value
+    of None returns an InternalError result for that metric.
+    """
     return [
-        "get_metric_statistics",
-        {"Datapoints": [{"Sum": datapoints_sum}]},
+        "get_metric_data",
+        {
+            "MetricDataResults": [
+                metric_data_result("m%d" % i, value)
+                for i, (_, value) in enumerate(metrics)
+            ]
+        },
         {
-            "Dimensions": [
-                {"Name": "LoadBalancer", "Value": "app/login-idp-alb-pretend/1234"}
+            "MetricDataQueries": [
+                metric_data_query("m%d" % i, metric_name, period)
+                for i, (metric_name, _) in enumerate(metrics)
             ],
-            "EndTime": ANY,
-            "MetricName": metric_name,
-            "Namespace": "AWS/ApplicationELB",
-            "Period": 2073600,
-            "StartTime": ANY,
-            "Statistics": ["Sum"],
+            "StartTime": start_time,
+            "EndTime": end_time,
         },
     ]
 
 
-def put_metric_data(metric_name, value):
+def put_metric_data(metrics):
+    """
+    metrics is a list of (metric_name, value) tuples, in SLI order
+    """
     return [
         "put_metric_data",
         {},
         {
-            "MetricData": [{"MetricName": metric_name, "Value": value}],
+            "MetricData": [
+                {"MetricName": metric_name, "Value": value}
+                for metric_name, value in metrics
+            ],
             "Namespace": "test/sli",
         },
     ]
@@ -52,12 +105,18 @@ def put_metric_data(metric_name, value):
 def test_simple_sli():
     cw = boto3.client("cloudwatch", region_name="us-west-2")
     with Stubber(cw) as stubber:
-        stubber.add_response(*get_metric_statistics("HTTPCode_Target_2XX_Count", 2))
-        stubber.add_response(*get_metric_statistics("RequestCount", 4))
-        stubber.add_response(*get_metric_statistics("HTTPCode_ELB_5XX_Count", 2))
-        stubber.add_response(*put_metric_data("test-http-200-availability", 1 / 3))
+        stubber.add_response(
+            *get_metric_data(
+                [
+                    ("HTTPCode_Target_2XX_Count", 2),
+                    ("RequestCount", 4),
+                    ("HTTPCode_ELB_5XX_Count", 2),
+                ]
+            )
+        )
+        stubber.add_response(*put_metric_data([("test-http-200-availability", 1 / 3)]))
 
-        Cloudwatch.cloudwatch_client = cw
+        windowed_slo.CLOUDWATCH = cw
 
         sli_config = {
             "http-200-availability": {
@@ -109,14 +168,20 @@ def test_multiple_metric_sli():
     cw = boto3.client("cloudwatch", region_name="us-west-2")
 
     with Stubber(cw) as stubber:
-        stubber.add_response(*get_metric_statistics("HTTPCode_Target_2XX_Count", 2))
-        stubber.add_response(*get_metric_statistics("HTTPCode_Target_3XX_Count", 1))
-        stubber.add_response(*get_metric_statistics("HTTPCode_Target_4XX_Count", 1))
-        stubber.add_response(*get_metric_statistics("RequestCount", 6))
-        stubber.add_response(*get_metric_statistics("HTTPCode_ELB_5XX_Count", 2))
-        stubber.add_response(*put_metric_data("test-all-availability", 0.5))
+        stubber.add_response(
+            *get_metric_data(
+                [
+                    ("HTTPCode_Target_2XX_Count", 2),
+                    ("HTTPCode_Target_3XX_Count", 1),
+                    ("HTTPCode_Target_4XX_Count", 1),
+                    ("RequestCount", 6),
+                    ("HTTPCode_ELB_5XX_Count", 2),
+                ]
+            )
+        )
+        stubber.add_response(*put_metric_data([("test-all-availability", 0.5)]))
 
-        Cloudwatch.cloudwatch_client = cw
+        windowed_slo.CLOUDWATCH = cw
 
         sli_config = {
             "all-availability": {
@@ -182,6 +247,201 @@ def test_multiple_metric_sli():
         publish_slis(slis, SLI_NAMESPACE, SLI_PREFIX, handle_exceptions=False)
 
 
+def availability_sli(window_days, numerator, denominator):
+    return {
+        "window_days": window_days,
+        "numerator": [
+            {
+                "namespace": "AWS/ApplicationELB",
+                "metric_name": numerator,
+                "dimensions": [{"Name": "LoadBalancer", "Value": LOAD_BALANCER_ID}],
+            }
+        ],
+        "denominator": [
+            {
+                "namespace": "AWS/ApplicationELB",
+                "metric_name": denominator,
+                "dimensions": [{"Name": "LoadBalancer", "Value": LOAD_BALANCER_ID}],
+            }
+        ],
+    }
+
+
+@mock_aws
+def test_multiple_window_slis():
+    cw = boto3.client("cloudwatch", region_name="us-west-2")
+    now = datetime.datetime(2024, 6, 1, 12, 0, 0)
+
+    with Stubber(cw) as stubber:
+        # One GetMetricData call per distinct window, covering every SLI in it,
+        # all ending at the same moment. RequestCount is shared by two SLIs in
+        # the first window, so it is only queried once there.
+        stubber.add_response(
+            *get_metric_data(
+                [
+                    ("HTTPCode_Target_2XX_Count", 3),
+                    ("RequestCount", 4),
+                    ("HTTPCode_Target_3XX_Count", 1),
+                ],
+                start_time=datetime.datetime(2024, 5, 8, 12, 0, 0),
+                end_time=now,
+            )
+        )
+        stubber.add_response(
+            *get_metric_data(
+                [("HTTPCode_Target_2XX_Count", 9), ("RequestCount", 10)],
+                period=2592000,
+                start_time=datetime.datetime(2024, 5, 2, 12, 0, 0),
+                end_time=now,
+            )
+        )
+        stubber.add_response(
+            *put_metric_data(
+                [
+                    ("test-2xx-availability", 0.75),
+                    ("test-3xx-availability", 0.25),
+                    ("test-2xx-availability-30d", 0.9),
+                ]
+            )
+        )
+
+        windowed_slo.CLOUDWATCH = cw
+
+        sli_config = {
+            "2xx-availability": availability_sli(
+                None, "HTTPCode_Target_2XX_Count", "RequestCount"
+            ),
+            "3xx-availability": availability_sli(
+                24, "HTTPCode_Target_3XX_Count", "RequestCount"
+            ),
+            "2xx-availability-30d": availability_sli(
+                30, "HTTPCode_Target_2XX_Count", "RequestCount"
+            ),
+        }
+        slis = parse_sli_json(
+            json.dumps(sli_config), handle_exceptions=False, end_time=now
+        )
+        publish_slis(slis, SLI_NAMESPACE, SLI_PREFIX, handle_exceptions=False)
+
+
+@mock_aws
+def test_shared_metric_queried_once():
+    cw = boto3.client("cloudwatch", region_name="us-west-2")
+
+    with Stubber(cw) as stubber:
+        # RequestCount appears three times across both SLIs but is one query
+        stubber.add_response(
+            *get_metric_data([("HTTPCode_Target_2XX_Count", 3), ("RequestCount", 4)])
+        )
+        stubber.add_response(
+            *put_metric_data(
+                [("test-2xx-availability", 0.75), ("test-half-requests", 0.5)]
+            )
+        )
+
+        windowed_slo.CLOUDWATCH = cw
+
+        half_requests = availability_sli(None, "RequestCount", "RequestCount")
+        half_requests["numerator"][0]["multiplier"] = 0.5
+        sli_config = {
+            "2xx-availability": availability_sli(
+                None, "HTTPCode_Target_2XX_Count", "RequestCount"
+            ),
+            "half-requests": half_requests,
+        }
+        slis = parse_sli_json(json.dumps(sli_config), handle_exceptions=False)
+        publish_slis(slis, SLI_NAMESPACE, SLI_PREFIX, handle_exceptions=False)
+        stubber.assert_no_pending_responses()
+
+
+@mock_aws
+def test_failed_metric_skips_sli(capsys):
+    cw = boto3.client("cloudwatch", region_name="us-west-2")
+
+    with Stubber(cw) as stubber:
+        stubber.add_response(
+            *get_metric_data(
+                [
+                    ("HTTPCode_Target_2XX_Count", None),
+                    ("RequestCount", 100),
+                    ("HTTPCode_Target_3XX_Count", 25),
+                ]
+            )
+        )
+        # Only the SLI whose metrics all came back is published
+        stubber.add_response(*put_metric_data([("test-3xx-availability", 0.25)]))
+
+        windowed_slo.CLOUDWATCH = cw
+
+        sli_config = {
+            "2xx-availability": availability_sli(
+                None, "HTTPCode_Target_2XX_Count", "RequestCount"
+            ),
+            "3xx-availability": availability_sli(
+                None, "HTTPCode_Target_3XX_Count", "RequestCount"
+            ),
+        }
+        slis = parse_sli_json(json.dumps(sli_config), handle_exceptions=False)
+        publish_slis(slis, SLI_NAMESPACE, SLI_PREFIX, handle_exceptions=False)
+        stubber.assert_no_pending_responses()
+
+    assert (
+        "CloudWatch API error for 2xx-availability: InternalError"
+        in capsys.readouterr().out
+    )
+
+
+def failing_window_slis(cw, stubber):
+    stubber.add_response(
+        *get_metric_data([("HTTPCode_Target_2XX_Count", 3), ("RequestCount", 4)])
+    )
+    stubber.add_client_error(
+        "get_metric_data",
+        service_error_code="Throttling",
+        service_message="Rate exceeded",
+        http_status_code=400,
+    )
+    windowed_slo.CLOUDWATCH = cw
+
+    sli_config = {
+        "2xx-availability": availability_sli(
+            None, "HTTPCode_Target_2XX_Count", "RequestCount"
+        ),
+        "2xx-availability-30d": availability_sli(
+            30, "HTTPCode_Target_2XX_Count", "RequestCount"
+        ),
+    }
+    return parse_sli_json(json.dumps(sli_config), handle_exceptions=False)
+
+
+@mock_aws
+def test_failed_window_skips_only_its_slis(capsys):
+    cw = boto3.client("cloudwatch", region_name="us-west-2")
+
+    with Stubber(cw) as stubber:
+        slis = failing_window_slis(cw, stubber)
+        stubber.add_response(*put_metric_data([("test-2xx-availability", 0.75)]))
+
+        publish_slis(slis, SLI_NAMESPACE, SLI_PREFIX)
+        stubber.assert_no_pending_responses()
+
+    assert (
+        "CloudWatch API error for 2xx-availability-30d: An error occurred (Throttling)"
+        in capsys.readouterr().out
+    )
+
+
+@mock_aws
+def test_failed_window_raises_when_not_handled():
+    cw = boto3.client("cloudwatch", region_name="us-west-2")
+
+    with Stubber(cw) as stubber:
+        slis = failing_window_slis(cw, stubber)
+
+        with pytest.raises(botocore.exceptions.ClientError):
+            publish_slis(slis, SLI_NAMESPACE, SLI_PREFIX, handle_exceptions=False)
+
+
 def test_sad_config():
     # By default, blithely continue on
     with open(
@@ -200,6 +460,26 @@ def test_sad_config():
     assert "unexpected keyword argument 'nomnomnomerator'" in str(excinfo.value)
 
 
+def load_without_orjson():
+    spec = importlib.util.spec_from_file_location(
+        "windowed_slo_stdlib_json", windowed_slo.__file__
+    )
+    module = importlib.util.module_from_spec(spec)
+    with patch.dict(sys.modules, {"orjson": None}):
+        spec.loader.exec_module(module)
+    return module
+
+
+def test_stdlib_json_fallback():
+    module = load_without_orjson()
+
+    assert module.json_loads is json.loads
+    with open(
+        os.path.join(os.path.dirname(__file__), "windowed_slo_fixture_happy.json")
+    ) as f:
+        assert len(module.parse_sli_json(f.read(), handle_exceptions=False)) == 3
+
+
 def test_happy_config():
     # Ensure we can actually parse
     with open(
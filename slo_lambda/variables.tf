@@ -13,6 +13,12 @@ variable "lambda_runtime" {
   default     = "python3.12"
 }
 
+variable "layers" {
+  description = "List of Lambda layer ARNs to attach, e.g. one providing orjson for faster JSON parsing."
+  type        = list(string)
+  default     = []
+}
+
 variable "slo_lambda_code" {
   type        = string
   description = "Filename of the compressed lambda source code."
@@ -56,6 +62,7 @@ variable "slis" {
       dimensions         = list(map(string))
       statistic          = optional(string)
       extended_statistic = optional(string)
+      multiplier         = optional(number, 1)
     }))
     denominator = list(object({
       namespace          = string
@@ -63,6 +70,7 @@ variable "slis" {
       dimensions         = list(map(string))
       statistic          = optional(string)
       extended_statistic = optional(string)
+      multiplier         = optional(number, 1)
     }))
   }))
 }